@@ -1,33 +1,39 @@
+import functools
 import string
 import hashlib
 import re
+import warnings
 
-_ord = lambda byte: byte
-_escape_slug_safe_chars = set(string.ascii_lowercase + string.digits)
+_escape_slug_safe_chars = frozenset(string.ascii_lowercase + string.digits)
+# the same characters, for bytes.translate checks
+_escape_slug_safe_bytes = "".join(sorted(_escape_slug_safe_chars)).encode("ascii")
 SAFE = set(string.ascii_letters + string.digits)
 ESCAPE_CHAR = "-"
 
 
 _alpha_lower = tuple(string.ascii_lowercase)
 _alphanum_lower = tuple(string.ascii_lowercase + string.digits)
-
-# patterns _do not_ need to cover length or start/end conditions,
-# which are handled separately
-_object_pattern = re.compile(r"^[a-z0-9\-]+$")
-_label_pattern = re.compile(r"^[a-z0-9\.\-_]+$", flags=re.IGNORECASE)
-# match anything that's not lowercase alphanumeric (will be stripped, replaced with '-')
-_non_alphanum_pattern = re.compile(r"[^a-z0-9]+")
+_alphanum = tuple(string.ascii_letters + string.digits)
 
 _hash_length = 8
 
+# two-digit hex for every byte value, used by _escape_char
+_HEX = tuple(f"{b:02X}" for b in range(256))
+
 
 def escape(to_escape, safe=SAFE, escape_char=ESCAPE_CHAR, allow_collisions=False):
     if isinstance(to_escape, bytes):
         to_escape = to_escape.decode("utf8")
-    if not isinstance(safe, set):
-        safe = set(safe)
+    if escape_char == ESCAPE_CHAR and not allow_collisions:
+        # fast path for the default safe sets, their tables are built at import
+        if safe is _escape_slug_safe_chars:
+            return to_escape.translate(_escape_slug_table)
+        if safe is SAFE:
+            return to_escape.translate(_default_escape_table)
+    if not isinstance(safe, frozenset):
+        safe = frozenset(safe)
     if allow_collisions:
-        safe.add(escape_char)
+        safe |= {escape_char}
     elif escape_char in safe:
         warnings.warn(
             f"Escape character {escape_char!r} cannot be a safe character."
@@ -35,15 +41,40 @@ def escape(to_escape, safe=SAFE, escape_char=ESCAPE_CHAR, allow_collisions=False
             RuntimeWarning,
             stacklevel=2,
         )
-        safe.remove(escape_char)
+        safe -= {escape_char}
+
+    return to_escape.translate(_escape_table(safe, escape_char))
+
+
+class _TranslateTable(dict):
+    """Lazily-filled str.translate table
+
+    translate_char maps a single character to its replacement string.
+    ASCII is filled in up front,
+    other code points are computed and cached the first time they are seen.
+    """
+
+    def __init__(self, translate_char):
+        super().__init__()
+        self.translate_char = translate_char
+        for i in range(128):
+            self[i] = translate_char(chr(i))
 
-    chars = []
-    for c in to_escape:
+    def __missing__(self, key):
+        value = self[key] = self.translate_char(chr(key))
+        return value
+
+
+@functools.lru_cache(maxsize=32)
+def _escape_table(safe, escape_char):
+    """str.translate table for escape()"""
+
+    def translate_char(c):
         if c in safe:
-            chars.append(c)
-        else:
-            chars.append(_escape_char(c, escape_char))
-    return "".join(chars)
+            return c
+        return _escape_char(c, escape_char)
+
+    return _TranslateTable(translate_char)
 
 
 def escape_slug(name):
@@ -56,30 +87,45 @@ def escape_slug(name):
 
 
 def _escape_char(c, escape_char):
-    buf = []
-    for byte in c.encode("utf8"):
-        buf.append(escape_char)
-        buf.append(f"{_ord(byte):X}")
-    return "".join(buf)
+    return "".join([escape_char + _HEX[byte] for byte in c.encode("utf8")])
+
+
+# tables for escape()'s fast path
+_escape_slug_table = _escape_table(_escape_slug_safe_chars, ESCAPE_CHAR)
+_default_escape_table = _escape_table(frozenset(SAFE), ESCAPE_CHAR)
+
+
+def _escaped_bytes_pattern(escape_char):
+    """Pattern matching a run of escaped bytes, e.g. '-C3-A9'"""
+    return re.compile(rf"(?:{re.escape(escape_char)}[0-9A-Fa-f]{{2}})+")
+
+
+def _decode_escaped_bytes(match, escape_char=ESCAPE_CHAR):
+    # decode the whole run at once, so multi-byte utf8 characters survive
+    hex_value = match.group(0).replace(escape_char, "")
+    return bytes.fromhex(hex_value).decode("utf-8", "replace")
+
+
+# bound .sub of the default pattern, with the default replacement already applied
+_revert_default_escape = functools.partial(
+    _escaped_bytes_pattern(ESCAPE_CHAR).sub, _decode_escaped_bytes
+)
 
 
 def revert_escape(escaped_str, escape_char=ESCAPE_CHAR):
-    decoded_chars = []
-    i = 0
-    while i < len(escaped_str):
-        if escaped_str[i] == escape_char:
-            hex_value = escaped_str[i + 1 : i + 3]
-            if len(hex_value) == 2 and all(c in string.hexdigits for c in hex_value):
-                byte_value = int(hex_value, 16)
-                decoded_chars.append(bytes([byte_value]).decode("utf-8"))
-                i += 3  # Move past the escape character and two hex digits
-            else:
-                decoded_chars.append(escaped_str[i])
-                i += 1
-        else:
-            decoded_chars.append(escaped_str[i])
-            i += 1
-    return "".join(decoded_chars)
+    if escape_char == ESCAPE_CHAR:
+        return _revert_default_escape(escaped_str)
+    pattern = _escaped_bytes_pattern(escape_char)
+    return pattern.sub(
+        functools.partial(_decode_escaped_bytes, escape_char=escape_char),
+        escaped_str,
+    )
+
+
+# cast to lowercase, replace anything that's not lowercase alphanumeric with '-'
+_safe_name_table = _TranslateTable(
+    lambda c: "".join([lc if lc in _alphanum_lower else "-" for lc in c.lower()])
+)
 
 
 def _extract_safe_name(name, max_length):
@@ -95,9 +141,11 @@ def _extract_safe_name(name, max_length):
     - max length not exceeded
     """
     # compute safe slug from name (don't worry about collisions, hash handles that)
-    # cast to lowercase
-    # replace any sequence of non-alphanumeric characters with a single '-'
-    safe_name = _non_alphanum_pattern.sub("-", name.lower())
+    # cast to lowercase, replace non-alphanumeric characters with '-'
+    safe_name = name.translate(_safe_name_table)
+    # collapse any sequence of '-' into a single '-'
+    while "--" in safe_name:
+        safe_name = safe_name.replace("--", "-")
     # truncate to max_length chars, strip '-' off ends
     safe_name = safe_name.lstrip("-")[:max_length].rstrip("-")
     # ensure starts with lowercase letter
@@ -119,6 +167,8 @@ def strip_and_hash(name, max_length=32):
     if name_length < 1:
         raise ValueError(f"Cannot make safe names shorter than {_hash_length + 4}")
     # quick, short hash to avoid name collisions
+    # this must stay sha256: the suffix has to match the slugs kubespawner
+    # generates for the same user, or the renamed directories won't be found
     name_hash = hashlib.sha256(name.encode("utf8")).hexdigest()[:_hash_length]
     safe_name = _extract_safe_name(name, name_length)
     # due to stripping of '-' in _extract_safe_name,
@@ -139,28 +189,37 @@ def is_valid_default(s):
     return is_valid_object_name(s)
 
 
-def _is_valid_general(
-    s, starts_with=None, ends_with=None, pattern=None, min_length=None, max_length=None
+def _make_validator(
+    name, doc, starts_with, ends_with, valid_chars, min_length, max_length
 ):
-    """General is_valid check
+    """Make a specialized is_valid check for one fixed set of rules
+
+    Rules are bound once, so each check is a single expression.
+    valid_chars are deleted with bytes.translate,
+    anything left over is not allowed.
 
-    Checks rules:
+    name and doc become the returned check's __name__ and __doc__.
     """
-    if min_length and len(s) < min_length:
-        return False
-    if max_length and len(s) > max_length:
-        return False
-    if starts_with and not s.startswith(starts_with):
-        return False
-    if ends_with and not s.endswith(ends_with):
-        return False
-    if pattern and not pattern.match(s):
-        return False
-    return True
-
-
-def is_valid_object_name(s):
-    """is_valid check for object names
+    valid_bytes = valid_chars.encode("ascii")
+
+    def is_valid(s):
+        return (
+            min_length <= len(s) <= max_length
+            and s.startswith(starts_with)
+            and s.endswith(ends_with)
+            and s.isascii()
+            and not s.encode("ascii").translate(None, valid_bytes)
+        )
+
+    is_valid.__name__ = is_valid.__qualname__ = name
+    is_valid.__doc__ = doc
+    return is_valid
+
+
+# object rules: https://kubernetes.io/docs/concepts/overview/working-with-objects/names/#names
+is_valid_object_name = _make_validator(
+    name="is_valid_object_name",
+    doc="""is_valid check for object names
 
     Ensures all strictest object rules apply,
     satisfying both RFC 1035 and 1123 dns label name rules
@@ -168,31 +227,32 @@ def is_valid_object_name(s):
     - 63 characters
     - starts with letter, ends with letter or number
     - only lowercalse letters, numbers, '-'
-    """
-    # object rules: https://kubernetes.io/docs/concepts/overview/working-with-objects/names/#names
-    return _is_valid_general(
-        s,
-        starts_with=_alpha_lower,
-        ends_with=_alphanum_lower,
-        pattern=_object_pattern,
-        max_length=63,
-        min_length=1,
-    )
+    """,
+    starts_with=_alpha_lower,
+    ends_with=_alphanum_lower,
+    valid_chars=string.ascii_lowercase + string.digits + "-",
+    min_length=1,
+    max_length=63,
+)
+
+# label rules: https://kubernetes.io/docs/concepts/overview/working-with-objects/labels/#syntax-and-character-set
+_is_valid_nonempty_label = _make_validator(
+    name="_is_valid_nonempty_label",
+    doc="""is_valid check for non-empty label values""",
+    starts_with=_alphanum,
+    ends_with=_alphanum,
+    valid_chars=string.ascii_letters + string.digits + ".-_",
+    min_length=1,
+    max_length=63,
+)
 
 
 def is_valid_label(s):
     """is_valid check for label values"""
-    # label rules: https://kubernetes.io/docs/concepts/overview/working-with-objects/labels/#syntax-and-character-set
     if not s:
         # empty strings are valid labels
         return True
-    return _is_valid_general(
-        s,
-        starts_with=_alphanum,
-        ends_with=_alphanum,
-        pattern=_label_pattern,
-        max_length=63,
-    )
+    return _is_valid_nonempty_label(s)
 
 
 def safe_slug(name, is_valid=is_valid_default, max_length=None):
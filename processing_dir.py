@@ -1,22 +1,38 @@
 import os
-from escape_to_safe_slug import revert_escape, safe_slug, escape_slug
+from escape_to_safe_slug import (
+    ESCAPE_CHAR,
+    _escape_slug_safe_bytes,
+    escape_slug,
+    revert_escape,
+    safe_slug,
+)
 import shutil
 import argparse
+import errno
+import logging
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+
+log = logging.getLogger(__name__)
+
+# os.rename errors meaning the destination directory already exists
+_new_dir_exists_errnos = (errno.EEXIST, errno.ENOTEMPTY, errno.EISDIR)
 
 
 def get_subdir_paths_with_suffix(base_dir, suffix="-filestore"):
     matching_paths = []
 
     if not os.path.exists(base_dir):
-        print(f"The directory {base_dir} does not exist.")
+        log.info("The directory %s does not exist.", base_dir)
         return matching_paths
 
     # Loop through all the subdirectories in the base directory
-    for subdir in os.listdir(base_dir):
-        subdir_path = os.path.join(base_dir, subdir)
-
-        if os.path.isdir(subdir_path) and subdir.endswith(suffix):
-            matching_paths.append(subdir_path)
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_dir():
+                matching_paths.append(entry.path)
 
     return matching_paths
 
@@ -27,30 +43,70 @@ def generate_prod_paths(base_dirs):
     # Loop through all base directories
     for base_dir in base_dirs:
         # Loop through all subdirectories under the base directory
-        for subdir in os.listdir(base_dir):
-            subdir_path = os.path.join(base_dir, subdir)
-
-            # Check if it's a directory and not 'lost+found'
-            if os.path.isdir(subdir_path) and subdir != "lost+found":
-                prod_dir_path = os.path.join(subdir_path, "prod")
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                # Check if it's a directory and not 'lost+found'
+                if entry.name != "lost+found" and entry.is_dir():
+                    prod_dir_path = os.path.join(entry.path, "prod")
 
-                # Check if the 'prod' directory exists inside the subdir
-                if os.path.isdir(prod_dir_path):
-                    prod_paths.append(prod_dir_path)
+                    # Check if the 'prod' directory exists inside the subdir
+                    if os.path.isdir(prod_dir_path):
+                        prod_paths.append(prod_dir_path)
 
     return prod_paths
 
 
-def is_old_schema(name):
+class _DirectoryLog:
+    """Collect the log messages for one directory, to log them as a single record"""
+
+    def __init__(self):
+        self.level = logging.INFO
+        self.lines = []
+
+    def info(self, msg, *args):
+        self._add(logging.INFO, msg, args)
+
+    def error(self, msg, *args):
+        self._add(logging.ERROR, msg, args)
+
+    def _add(self, level, msg, args):
+        self.level = max(self.level, level)
+        if log.isEnabledFor(level):
+            self.lines.append(msg % args if args else msg)
+
+    def flush(self):
+        if self.lines:
+            log.log(self.level, "%s", "\n".join(self.lines))
+            self.lines = []
+
+
+def _is_empty_dir(path):
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+
+def is_old_schema(name, user_name=None, log=log):
+    """Whether name round-trips through the old escape_slug scheme
+
+    user_name can be passed if name has already been decoded with revert_escape.
+    log can be passed to collect the message about names that can't be decoded.
+    """
+    if ESCAPE_CHAR not in name:
+        # nothing to decode, so name round-trips only if escape_slug leaves it alone
+        return name.isascii() and not name.encode("ascii").translate(
+            None, _escape_slug_safe_bytes
+        )
     try:
-        user_name = revert_escape(name)
+        if user_name is None:
+            user_name = revert_escape(name)
         escaped_name = escape_slug(user_name)
         if name == escaped_name:
             return True
         return False
     except Exception:
-        print(
-            f"Could not decode the username by assuming the username was encoded with escaped logic. "
+        log.info(
+            "Could not decode the username of '%s' by assuming the username was encoded with escaped logic. ",
+            name,
         )
         return False
 
@@ -61,81 +117,140 @@ def process_subdir_name(name, path, force=False):
     ---a. If a directory with the new scheme exists, move the old directory into the new one and name it _old_home
     ---b. If a directory with the new scheme does not exist, rename the old directory to one using the new scheme
     """
+    ## Collect this directory's messages and log them as one block,
+    ## so parallel runs don't interleave lines from different directories.
+    dir_log = _DirectoryLog()
+    try:
+        _process_subdir_name(name, path, force, dir_log)
+    finally:
+        dir_log.flush()
+
+
+def _process_subdir_name(name, path, force, dir_log):
+    dir_log.info("========  Processing  %s   ========", path)
+    ## Decode the name as if it used the old schema,
+    ## then check if old or new schema.
+    ## Names without an escape character have nothing to decode.
+    if ESCAPE_CHAR in name:
+        user_name = revert_escape(name, escape_char=ESCAPE_CHAR)
+    else:
+        user_name = name
+    is_old = is_old_schema(name, user_name, log=dir_log)
 
-    print("========  Processing ", path, "  ========")
-    ## Check if old or new schema
-    is_old = is_old_schema(name)
-
-    ## if old, decode it so that you know what the original username is.
+    ## if old, the decoded name is the original username.
     ## Use the original username to figure out what the new directory name will be.
     if is_old:
-        print(f"'{path}' is using the old naming scheme.")
-        user_name = revert_escape(name, escape_char="-")
-        print(f"username is '{user_name}'")
+        dir_log.info("'%s' is using the old naming scheme.", path)
+        dir_log.info("username is '%s'", user_name)
         new_name = safe_slug(user_name)
         parent_name = os.path.dirname(path)
         new_name_path = os.path.join(parent_name, new_name)
 
         if new_name_path == path:
-            print(f"Skipping '{path}'. ")
-            print("The new naming scheme is the same as the old naming scheme.")
+            dir_log.info("Skipping '%s'. ", path)
+            dir_log.info("The new naming scheme is the same as the old naming scheme.")
             return
-        ## If a directory with the new scheme exists,
-        ## move the old directory into the new one and name it _old_home
-        if os.path.exists(new_name_path) and os.path.isdir(new_name_path):
-            print(
-                f" '{new_name_path}' already exists, moving the old directory into the new one."
-            )
-            dest = os.path.join(new_name_path, name)
+        ## Try renaming the old directory to the one using the new scheme first.
+        ## rename() fails if a non-empty directory with the new scheme already exists,
+        ## and replaces it if it is empty.
+        ## This saves checking for it first, which is slow on nfs.
+        if force:
             try:
-                if force:
-                    shutil.move(path, dest)
-                print(f"Successfully moved '{path}' tp '{dest}'. ")
-                if force:
-                    os.rename(dest, os.path.join(new_name_path, "_old_home"))
-                print(f"Successfully renamed '{dest}' to _old_home. ")
-            except Exception as e:
-                print(f"Error: Failed to move and rename '{path}'. {e} ")
-        ## If a directory with the new scheme does not exist,
-        ## rename the old directory to the one using the new scheme
+                os.rename(path, new_name_path)
+            except OSError as e:
+                if e.errno not in _new_dir_exists_errnos:
+                    dir_log.error("Error: Failed to move and rename '%s'. %s ", path, e)
+                    return
+                renamed = False
+            else:
+                renamed = True
+                ## all that's known is that rename() didn't find a non-empty directory
+                rename_msg = " '%s' did not exist or was empty, renaming the old directory to the new one."
         else:
-            print(
-                f" '{new_name_path}' does not exist, renaming the old directory to the new one."
-            )
-            try:
-                if force:
-                    os.rename(path, new_name_path)
-                print(f"Successfully renamed '{path}' to '{new_name_path}'. ")
-            except Exception as e:
-                print(f"Error: Failed to move and rename '{path}'. {e} ")
+            ## dry run: preview what rename() will do
+            renamed = not os.path.isdir(new_name_path)
+            if renamed:
+                rename_msg = " '%s' does not exist, renaming the old directory to the new one."
+            else:
+                try:
+                    renamed = _is_empty_dir(new_name_path)
+                except OSError as e:
+                    ## e.g. no permission to list it, don't let the preview fail over it
+                    dir_log.info(
+                        "Could not check if '%s' is empty, assuming it is not. %s ",
+                        new_name_path,
+                        e,
+                    )
+                rename_msg = " '%s' exists but is empty, replacing it with the old directory."
+
+        ## If a directory with the new scheme does not exist or is empty,
+        ## the old directory is renamed to the one using the new scheme
+        if renamed:
+            dir_log.info(rename_msg, new_name_path)
+            dir_log.info("Successfully renamed '%s' to '%s'. ", path, new_name_path)
+            return
+
+        ## If a non-empty directory with the new scheme exists,
+        ## move the old directory into the new one and name it _old_home
+        dir_log.info(
+            " '%s' already exists, moving the old directory into the new one.",
+            new_name_path,
+        )
+        dest = os.path.join(new_name_path, name)
+        try:
+            if force:
+                shutil.move(path, dest)
+            dir_log.info("Successfully moved '%s' tp '%s'. ", path, dest)
+            if force:
+                os.rename(dest, os.path.join(new_name_path, "_old_home"))
+            dir_log.info("Successfully renamed '%s' to _old_home. ", dest)
+        except Exception as e:
+            dir_log.error("Error: Failed to move and rename '%s'. %s ", path, e)
     else:
-        print(f"'{path}' is using the new naming scheme.")
-        print(f"Skipping '{path}'")
+        dir_log.info("'%s' is using the new naming scheme.", path)
+        dir_log.info("Skipping '%s'", path)
 
 
 def rename_subdirs(
     base_dirs="/Users/la-yijunge/Downloads/export",
     exclude_dir_lists=["_shared"],
     force=False,
+    workers=1,
 ):
     if not force:
-        print(
+        log.info(
             "================== This is a dry run. No changes are made. ================ "
         )
     else:
-        print(
+        log.info(
             "================== This is NOT a dry run. Directories will be moved. =============== "
         )
+    subdirs = []
     for base_dir in base_dirs:
         # Check if the base directory exists
         if not os.path.exists(base_dir):
-            print(f"The directory {base_dir} does not exist.")
+            log.info("The directory %s does not exist.", base_dir)
             continue
 
-        for subdir in os.listdir(base_dir):
-            subdir_path = os.path.join(base_dir, subdir)
-            if os.path.isdir(subdir_path) and subdir not in exclude_dir_lists:
-                process_subdir_name(subdir, subdir_path, force)
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                if entry.name not in exclude_dir_lists and entry.is_dir():
+                    subdirs.append((entry.name, entry.path))
+
+    if workers <= 1:
+        for name, path in subdirs:
+            process_subdir_name(name, path, force)
+        return
+
+    ## Each subdir is renamed independently, and the time is spent waiting on
+    ## (nfs) filesystem calls, so threads can overlap them.
+    with ThreadPoolExecutor(max_workers=min(workers, len(subdirs) or 1)) as executor:
+        futures = [
+            executor.submit(process_subdir_name, name, path, force)
+            for name, path in subdirs
+        ]
+        for future in futures:
+            future.result()
 
 
 def main():
@@ -168,7 +283,14 @@ def main():
         help="dirs to skip. For example, '_shared'.",
         default=["_shared"],
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of directories to process in parallel. Useful on slow (nfs) filesystems.",
+        default=1,
+    )
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
 
     # Get all subdirectories with the suffix '-filestore'
     matching_subdirs = get_subdir_paths_with_suffix(args.base_dir, args.suffix)
@@ -178,14 +300,30 @@ def main():
 
     # Output the found 'prod' directories
     if prod_directories:
-        print("Found 'prod' directories:")
+        log.info("Found 'prod' directories:")
         for path in prod_directories:
-            print(path)
+            log.info(path)
     else:
-        print("No 'prod' directories found.")
+        log.info("No 'prod' directories found.")
 
     # Rename subdirectories based on the escape_to_safe_slug logic
-    rename_subdirs(prod_directories, args.exclude_dir_lists, args.force)
+    if args.workers <= 1:
+        rename_subdirs(prod_directories, args.exclude_dir_lists, args.force)
+        return
+
+    ## When running in parallel, workers only put log records on a queue,
+    ## a single listener thread writes them out.
+    root_logger = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root_logger.handlers)
+    root_logger.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    try:
+        rename_subdirs(
+            prod_directories, args.exclude_dir_lists, args.force, args.workers
+        )
+    finally:
+        listener.stop()
 
     ## Test a specific directory
     # rename_subdirs(['/export/biology-filestore/biology/prod'], exclude_dir_lists)